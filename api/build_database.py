@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+Build the on-disk DuckDB database served by the API (see main.py).
+Run once before deploying, so cold starts do not need to fetch the parquet
+file and rebuild the table and index.
+"""
+import duckdb
+import os
+
+DATABASE_FILE = os.path.join(os.path.dirname(__file__), "solareignung.duckdb")
+
+if os.path.exists(DATABASE_FILE):
+    os.remove(DATABASE_FILE)
+con = duckdb.connect(DATABASE_FILE)
+
+con.sql(f"INSTALL httpfs;")
+con.sql(f"LOAD httpfs;")
+
+con.sql(f"INSTALL spatial;")
+con.sql(f"LOAD spatial;")
+
+s3_access_key_id = os.getenv("API_GCS_ACCESS_KEY_ID")
+s3_secret_access_key = os.getenv("API_GCS_ACCESS_KEY")
+assert s3_access_key_id and s3_secret_access_key
+con.sql("SET s3_endpoint = 'storage.googleapis.com';")
+con.sql(f"SET s3_access_key_id = '{s3_access_key_id}';")
+con.sql(f"SET s3_secret_access_key = '{s3_secret_access_key}';")
+
+# Build table and index from parquet file. Transform geometries to WGS84
+# GeoJSON once at build time, so requests do not have to.
+# Also materialize the bbox of the native geometry, replacing the bbox column
+# written by generate_test_data.py. The native geometry itself is not kept, so
+# the API can open the database without installing the spatial extension.
+con.sql(
+    """
+    CREATE TABLE solareignung AS
+    SELECT
+        * EXCLUDE (bbox, geom_2056),
+        ST_AsGeoJSON(ST_FlipCoordinates(ST_Transform(geom_2056, 'EPSG:2056', 'EPSG:4326'))) AS geom_geojson,
+        {
+            'xmin': ST_XMin(geom_2056),
+            'ymin': ST_YMin(geom_2056),
+            'xmax': ST_XMax(geom_2056),
+            'ymax': ST_YMax(geom_2056)
+        } AS bbox
+    FROM (
+        SELECT *, ST_GeomFromWKB(geometry) AS geom_2056
+        FROM read_parquet('s3://folimar-geotest-store001/landing/api_testdata/solareignung.parquet')
+    );
+    """
+)
+con.sql("CREATE INDEX idx_egid ON solareignung (egid);")
+
+con.close()
@@ -1,3 +1,8 @@
+# Build the database with the duckdb version the function runs (requirements.txt),
+# otherwise the storage format may not be readable at runtime.
+pip install -r requirements.txt
+python build_database.py
+
 gcloud functions deploy egid_lookup \
     --project=folimar-geotest \
     --gen2 \
@@ -1,18 +1,25 @@
 # -*- coding: utf-8 -*-
-import subprocess
+import geopandas as gpd
 from upath import UPath
 
+ROW_GROUP_SIZE = 8192
+
 sink_path = UPath(
     "gs://folimar-geotest-store001/landing/api_testdata/solareignung.parquet"
 )
 source_path = UPath("/workspaces/pretty_panda/data/poc_data/demo_biel.fgb")
 
+# Order features along a hilbert curve and add a bbox column, so that
+# each row group covers a compact area and can be skipped by readers
+# based on its min/max statistics.
+gdf = gpd.read_file(source_path, engine="pyogrio")
+gdf = gdf.iloc[gdf.geometry.hilbert_distance().values.argsort()]
+bounds = gdf.bounds.rename(
+    columns={"minx": "xmin", "miny": "ymin", "maxx": "xmax", "maxy": "ymax"}
+)
+gdf["bbox"] = bounds.to_dict("records")
+
 sink_path.parent.mkdir(parents=True, exist_ok=True)
 sink_path.unlink(missing_ok=True)
-cmd = [
-    "ogr2ogr",
-    "-progress",
-    f"{str(sink_path).replace('gs://', '/vsigs/')}",
-    f"{source_path}",
-]
-subprocess.run(cmd, check=True)
+with sink_path.open("wb") as f:
+    gdf.to_parquet(f, index=False, row_group_size=ROW_GROUP_SIZE)
@@ -1,28 +1,30 @@
 # -*- coding: utf-8 -*-
 import duckdb
 import functions_framework
-import json
+import orjson
 from datetime import datetime
 import os
 
-duckdb.sql(f"INSTALL httpfs;")
-duckdb.sql(f"LOAD httpfs;")
+# Database prebuilt by build_database.py and deployed alongside this file.
+DATABASE_FILE = os.path.join(os.path.dirname(__file__), "solareignung.duckdb")
 
-duckdb.sql(f"INSTALL spatial;")
-duckdb.sql(f"LOAD spatial;")
+# The table has no spatial types, so no extension needs to be installed.
+con = duckdb.connect(DATABASE_FILE, read_only=True)
 
-s3_access_key_id = os.getenv("API_GCS_ACCESS_KEY_ID")
-s3_secret_access_key = os.getenv("API_GCS_ACCESS_KEY")
-assert s3_access_key_id and s3_secret_access_key
-duckdb.sql("SET s3_endpoint = 'storage.googleapis.com';")
-duckdb.sql(f"SET s3_access_key_id = '{s3_access_key_id}';")
-duckdb.sql(f"SET s3_secret_access_key = '{s3_secret_access_key}';")
+SAMPLE_EGID_QUERY = "SELECT egid FROM solareignung USING SAMPLE 1;"
 
-# Build index on parquet file
-duckdb.sql(
-    f"CREATE TABLE IF NOT EXISTS solareignung AS SELECT * FROM read_parquet('s3://folimar-geotest-store001/landing/api_testdata/solareignung.parquet');"
-)
-duckdb.sql("CREATE INDEX IF NOT EXISTS idx_egid ON solareignung (egid);")
+EGID_LOOKUP_QUERY = """
+    SELECT
+        egid,
+        area_ratio_original::DOUBLE AS area_ratio_original,
+        flaeche::DOUBLE AS flaeche,
+        stromertrag::DOUBLE AS stromertrag,
+        geom_geojson,
+        SUM(flaeche) OVER ()::DOUBLE AS total_flaeche,
+        SUM(stromertrag) OVER ()::DOUBLE AS total_stromertrag
+    FROM solareignung
+    WHERE egid = ?;
+"""
 
 
 @functions_framework.http
@@ -30,34 +32,49 @@ def egid_lookup(request):
     request_json = request.get_json(silent=True)
     request_args = request.args
 
+    headers = {"Access-Control-Allow-Origin": "*"}
     start = datetime.now()
     if request_args and request_args.get("egid"):
-        # BAD BAD BAD NO SANITIZATION
-        egid = request_args["egid"].replace(";", "")
+        # Respond with egid as passed, validate it as integer for the lookup.
+        response_egid = request_args["egid"]
+        try:
+            egid = int(response_egid)
+        except ValueError:
+            return orjson.dumps({"error": "egid must be an integer"}), 400, headers
     else:
-        egid = duckdb.sql(f"SELECT egid FROM solareignung USING SAMPLE 1;").fetchall()[
-            0
-        ][0]
-    results = duckdb.sql(
-        f"SELECT egid, area_ratio_original, flaeche, stromertrag, ST_AsGeoJSON(ST_FlipCoordinates(ST_Transform(ST_GeomFromWKB(geometry), 'EPSG:2056', 'EPSG:4326'))) AS geom FROM solareignung WHERE egid={egid};"
-    ).fetchall()
-
-    response_dict = {"data": []}
-    for r in results:
-        response_dict["data"].append(
+        egid = None
+    # A cursor per request, so concurrent requests do not share connection state.
+    cur = con.cursor()
+    try:
+        if egid is None:
+            egid = cur.sql(SAMPLE_EGID_QUERY).fetchone()[0]
+            response_egid = egid
+        # Parameterized, so egid cannot inject SQL.
+        results = cur.execute(EGID_LOOKUP_QUERY, [egid]).arrow().to_pydict()
+    finally:
+        cur.close()
+
+    # Geometries are already GeoJSON strings and are embedded without reparsing.
+    response_dict = {
+        "data": [
             {
-                "area_ratio_original": float(r[1]),
-                "flaeche": float(r[2]),
-                "stromertrag": float(r[3]),
-                "geometry": json.loads(r[4]),
+                "area_ratio_original": area_ratio_original,
+                "flaeche": flaeche,
+                "stromertrag": stromertrag,
+                "geometry": orjson.Fragment(geom_geojson),
             }
-        )
-    response_dict["egid"] = egid
-    response_dict["total_flaeche"] = sum([r["flaeche"] for r in response_dict["data"]])
-    response_dict["total_stromertrag"] = sum(
-        [r["stromertrag"] for r in response_dict["data"]]
-    )
+            for area_ratio_original, flaeche, stromertrag, geom_geojson in zip(
+                results["area_ratio_original"],
+                results["flaeche"],
+                results["stromertrag"],
+                results["geom_geojson"],
+            )
+        ]
+    }
+    response_dict["egid"] = response_egid
+    # Totals are computed in SQL and repeated on every row.
+    response_dict["total_flaeche"] = next(iter(results["total_flaeche"]), 0.0)
+    response_dict["total_stromertrag"] = next(iter(results["total_stromertrag"]), 0.0)
     response_dict["processing_time_s"] = (datetime.now() - start).total_seconds()
 
-    headers = {"Access-Control-Allow-Origin": "*"}
-    return json.dumps(response_dict), 200, headers
+    return orjson.dumps(response_dict), 200, headers
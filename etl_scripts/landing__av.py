@@ -14,11 +14,29 @@ Note: For some cantons, data is not freely available but needs an applicationa
 and green-light. See here: https://geodienste.ch/services/av
 """
 
-from util import PandaPath, extract_zip_file, retry
-from datetime import datetime
+from util import (
+    PandaPath,
+    extract_zip_file,
+    delete_files,
+    retry,
+    get_http_session,
+    get_process_count,
+    get_io_concurrency,
+    COPY_BUFFER_SIZE,
+    make_valid_geometries,
+    read_json,
+    write_json,
+    parallel_copy_to,
+    get_ogr_union_vrt,
+)
 from multiprocessing.pool import Pool
-import subprocess
-from typing import List, Dict, Set, Tuple
+import asyncio
+import aiohttp
+from typing import List, Dict, Set, Tuple, Optional, KeysView
+import os
+import re
+import pyogrio
+from osgeo import gdal
 import logging
 import multiprocessing as mp
 
@@ -28,6 +46,8 @@ logging.basicConfig(
     datefmt="%Y-%m-%d %H:%M:%S",
 )
 
+gdal.UseExceptions()
+
 SOURCE_META_URL = PandaPath(
     "https://data.geo.admin.ch/ch.swisstopo-vd.amtliche-vermessung/meta.txt"
 )
@@ -40,6 +60,10 @@ SINK_FOLDER = PandaPath(
     "/workspaces/pretty_panda/data/landing/ch.swisstopo-vd.amtliche-vermessung"
 )
 
+META_VALIDATORS_FILE = SINK_FOLDER / "meta_validators.json"
+
+ZIP_ETAGS_FILE = SINK_FOLDER / "zip_etags.json"
+
 FILES_TO_EXTRACT = {
     PandaPath("de/Bo_BoFlaeche_A.shp"): SINK_FOLDER / "Bo_BoFlaeche_A.fgb",
     PandaPath("de/Bo_GebaeudenummerPos.shp"): SINK_FOLDER / "Bo_GebaeudenummerPos.fgb",
@@ -47,8 +71,40 @@ FILES_TO_EXTRACT = {
 }
 
 
+def fetch_meta_text(
+    meta_url_path: PandaPath, validators_file: PandaPath
+) -> Tuple[Optional[str], Dict[str, str]]:
+    """
+    Fetch the metadata text and its cache validators (ETag, Last-Modified).
+    If the metadata did not change since the validators stored in validators_file,
+    return (None, {}) without any payload transfer.
+    """
+    validators = read_json(validators_file, {})
+    headers = {}
+    if validators.get("ETag"):
+        headers["If-None-Match"] = validators["ETag"]
+    if validators.get("Last-Modified"):
+        headers["If-Modified-Since"] = validators["Last-Modified"]
+    response = get_http_session().get(str(meta_url_path), headers=headers)
+    if response.status_code == 304:
+        return None, {}
+    response.raise_for_status()
+    validators = {
+        k: response.headers[k]
+        for k in ("ETag", "Last-Modified")
+        if k in response.headers
+    }
+    return response.text, validators
+
+
+META_LINE_PATTERN = re.compile(
+    r"^(\S*/([^/\s]+)/(SHP)/([^/\s]+)/([^/\s]+\.zip)) (\d{4})-(\d{2})-(\d{2})",
+    re.MULTILINE,
+)
+
+
 def sink_source_map_from_meta(
-    meta_url_path: PandaPath, sink_raw_folder: PandaPath
+    meta_text: str, sink_raw_folder: PandaPath
 ) -> List[Dict[str, PandaPath]]:
     """
     Parse metadata and return a list of tuples with the zip source and sink paths.
@@ -58,113 +114,198 @@ def sink_source_map_from_meta(
     - Meta file line: https://data.geo.admin.ch/ch.swisstopo-vd.amtliche-vermessung/DM01AVCH24D/SHP/AG/4022.zip 2023-11-16
     - Filename: 20231116_DM01AVCH24D_SHP_AG_4022.zip
     """
-    meta_text = meta_url_path.read_text()
-    zip_sink_source_map = {}
-    for line in meta_text.splitlines():
-        zip_url, date_str = line.split(" ")
-        if "SHP" in zip_url:
-            asof = datetime.strptime(date_str, "%Y-%m-%d")
-            filename = "_".join(zip_url.rsplit("/", 4)[1:])
-            timestamp = asof.strftime("%Y%m%d")
-            zip_sink = sink_raw_folder / f"{timestamp}_{filename}"
-            zip_source = PandaPath(zip_url)
-            zip_sink_source_map[zip_sink] = zip_source
-    return zip_sink_source_map
-
-
-def delete_outdated_zip(incoming: Set[PandaPath], existing: Set[PandaPath]) -> None:
+    return {
+        sink_raw_folder / f"{y}{m}{d}_{a}_{b}_{c}_{z}": PandaPath(zip_url)
+        for zip_url, a, b, c, z, y, m, d in META_LINE_PATTERN.findall(meta_text)
+    }
+
+
+def delete_outdated_zip(
+    incoming: KeysView[PandaPath], existing: Set[PandaPath]
+) -> None:
     """
     Delete zip files that do not exist anymore in the new metadata or are outdated.
     """
-    to_delete = existing.difference(incoming)
+    to_delete = existing - incoming
     logging.info(f"Delete {len(to_delete)} outdated zip files...")
-    for p in to_delete:
-        p.unlink()
+    delete_files(to_delete)
 
 
-@retry
-def download_zip(args: Tuple[PandaPath, PandaPath]) -> None:
-    sink_path, source_path = args
-    source = source_path.read_bytes()
-    sink_path.write_bytes(source)
-    return f"Saved {sink_path.name}"
+def delete_outdated_chunks(
+    scratch_folder: PandaPath, zip_stems: Set[str], files_to_extract: Dict
+) -> None:
+    """
+    Delete chunks and processed markers of zip files which are no longer present.
+    Chunks of unchanged zip files are kept, so they do not need to be reprocessed.
+    """
+    outdated = [
+        p
+        for folder in [scratch_folder / f.stem / "chunks" for f in files_to_extract]
+        + [scratch_folder / "processed"]
+        for p in folder.glob("*")
+        if p.stem not in zip_stems
+    ]
+    logging.info(f"Delete {len(outdated)} outdated chunks and markers...")
+    delete_files(outdated)
+
+
+# More than a thousand concurrent requests to one host, give them more attempts.
+@retry(max_attempts=8)
+async def fetch_etag(
+    session: aiohttp.ClientSession, source_path: PandaPath
+) -> Optional[str]:
+    async with session.head(str(source_path), allow_redirects=True) as response:
+        response.raise_for_status()
+        return response.headers.get("ETag")
+
+
+@retry(max_attempts=8)
+async def download_zip(
+    session: aiohttp.ClientSession, sink_path: PandaPath, source_path: PandaPath
+) -> Optional[str]:
+    async with session.get(str(source_path)) as response:
+        response.raise_for_status()
+        # Sink writes may block (e.g. on remote storage), so they run in a
+        # worker thread to keep the event loop serving the other downloads.
+        sink = await asyncio.to_thread(sink_path.open, "wb")
+        try:
+            try:
+                async for chunk in response.content.iter_chunked(COPY_BUFFER_SIZE):
+                    await asyncio.to_thread(sink.write, chunk)
+            finally:
+                await asyncio.to_thread(sink.close)
+        except BaseException:
+            # Existing zip files are never downloaded again, so a failed or
+            # cancelled download must not leave a truncated one behind.
+            await asyncio.to_thread(sink_path.unlink, missing_ok=True)
+            raise
+    return response.headers.get("ETag")
+
+
+async def sync_zip(
+    session: aiohttp.ClientSession,
+    sink_path: PandaPath,
+    source_path: PandaPath,
+    previous_path: Optional[PandaPath],
+    etags: Dict[str, str],
+) -> Tuple[PandaPath, str, Optional[str]]:
+    """
+    Bring sink_path in place and return it with a log message and its source ETag.
+    Often only the asof date of a zip file changes, but not its content. If the
+    source ETag matches the one of the previous zip file of the same area, the
+    previous zip file is renamed instead of downloading the same content again.
+    """
+    if previous_path is not None and previous_path.name in etags:
+        etag = await fetch_etag(session, source_path)
+        if etag == etags[previous_path.name]:
+            await asyncio.to_thread(previous_path.rename, sink_path)
+            msg = f"Renamed unchanged {previous_path.name} to {sink_path.name}"
+            return sink_path, msg, etag
+    etag = await download_zip(session, sink_path, source_path)
+    return sink_path, f"Saved {sink_path.name}", etag
+
+
+async def download_zips(
+    sink_source_pairs: List[Tuple[PandaPath, PandaPath]],
+    existing: Set[PandaPath],
+    etags: Dict[str, str],
+) -> Dict[str, str]:
+    """
+    Download all zip files concurrently on a single event loop.
+    Return the source ETags of the zip files brought in place, keyed by file name.
+    """
+    # File names are "<asof>_<area>", the area identifies the previous version.
+    previous = {p.name.split("_", 1)[1]: p for p in existing}
+    new_etags = {}
+    connector = aiohttp.TCPConnector(limit_per_host=get_io_concurrency())
+    timeout = aiohttp.ClientTimeout(total=None, sock_read=60)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        tasks = [
+            sync_zip(
+                session,
+                sink_path,
+                source_path,
+                previous.get(sink_path.name.split("_", 1)[1]),
+                etags,
+            )
+            for sink_path, source_path in sink_source_pairs
+        ]
+        for i, task in enumerate(asyncio.as_completed(tasks), 1):
+            sink_path, result_msg, etag = await task
+            if etag:
+                new_etags[sink_path.name] = etag
+            logging.info(f"{i}/{len(tasks)} {result_msg}")
+    return new_etags
 
 
 @retry
 def process_zip(args) -> str:
     zip_path, files_to_extract, scratch_folder = args
-    # Extract zip
+    processed_marker = scratch_folder / "processed" / f"{zip_path.stem}.ok"
+    # Only extract the shapefiles of interest including their sidecar files
+    wanted = {os.path.splitext(p.as_posix())[0] for p in files_to_extract.keys()}
     zip_extract_folder = extract_zip_file(
-        zip_path, scratch_folder / "zip" / zip_path.stem
+        zip_path,
+        scratch_folder / "zip" / zip_path.stem,
+        predicate=lambda name: os.path.splitext(name)[0] in wanted,
     )
     for path_within_zip in files_to_extract.keys():
         file_path = zip_extract_folder / path_within_zip
         if not file_path.exists():
             logging.warning(f"File {file_path} does not exist in zip {zip_path.name}")
             continue
-        chunk_path = (
-            scratch_folder / file_path.stem / "chunks" / f"{zip_path.stem}.gpkg"
-        )
-        chunk_path.parent.mkdir(parents=True, exist_ok=True)
-        command = [
-            "ogr2ogr",
-            "--debug",
-            "OFF",
-            "-makevalid",
-            "-a_srs",
-            "EPSG:2056",
-            "-oo",
-            "encoding=Windows-1252",  # .cpg files indicate "1252", which ogr2ogr does not seem to understand.
-            "-lco",
-            "SPATIAL_INDEX=NO",
-            "-nlt",
-            "PROMOTE_TO_MULTI",
-            "-sql",
-            f"SELECT *, '{zip_path.stem}' as etl_zip_source FROM \"{file_path.stem}\"",
+        chunk_path = scratch_folder / file_path.stem / "chunks" / f"{zip_path.stem}.fgb"
+        # .cpg files indicate "1252", which GDAL does not seem to understand.
+        gdf = pyogrio.read_dataframe(file_path.as_gdal(), encoding="Windows-1252")
+        geoms = make_valid_geometries(gdf.geometry.values)
+        gdf = gdf.set_geometry(geoms, crs="EPSG:2056")
+        gdf["etl_zip_source"] = zip_path.stem
+        pyogrio.write_dataframe(
+            gdf,
             chunk_path.as_gdal(),
-            file_path.as_gdal(),
-        ]
-        subprocess.run(command, check=True)
+            layer=file_path.stem,
+            driver="FlatGeobuf",
+            promote_to_multi=True,
+            SPATIAL_INDEX="NO",
+        )
+        # Free the layer before reading the next one to bound peak memory.
+        del gdf, geoms
     zip_extract_folder.clean_dir()
     zip_extract_folder.rmdir()
+    processed_marker.write_text(zip_path.name)
     return f"Processed {zip_path.name}."
 
 
-@retry
+# Works on local scratch files only, failures are rarely transient.
+@retry(max_attempts=2)
 def combine(args) -> str:
     file_scratch_folder = args
-    chunks = file_scratch_folder / "chunks" / "*.gpkg"
-    combined_file = file_scratch_folder / f"combined.gpkg"
-    command = [
-        "ogrmerge.py",
-        "-f",
-        "GPKG",
-        "-single",
-        "-overwrite_ds",
-        "-o",
+    chunks_folder = file_scratch_folder / "chunks"
+    combined_file = file_scratch_folder / f"combined.fgb"
+    chunks = sorted(chunks_folder.glob("*.fgb"))
+    if not chunks:
+        # Not retryable, the chunks will not appear by trying again.
+        raise FileNotFoundError(f"No chunks found in {chunks_folder}")
+    # Stream the chunks through an OGR VRT union layer instead of loading all
+    # of them into memory. Chunk layers are named like the extracted file.
+    layer = file_scratch_folder.name
+    vrt = get_ogr_union_vrt(chunks, layer, src_layer=layer)
+    combined_file.unlink(missing_ok=True)
+    gdal.VectorTranslate(
         combined_file.as_gdal(),
-        chunks.as_gdal(),
-    ]
-    subprocess.run(command, check=True)
-    return f"Combined {chunks} into {combined_file}."
+        vrt,
+        options=gdal.VectorTranslateOptions(format="FlatGeobuf", layerName=layer),
+    )
+    return f"Combined {chunks_folder} into {combined_file}."
 
 
 @retry
 def upload(args) -> str:
     file_scratch_folder, sink_file = args
-    tmp_combined_file = file_scratch_folder / "combined.gpkg"
-    sink_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_combined_file = file_scratch_folder / "combined.fgb"
+    # The combined file already has the sink format, no conversion needed.
     sink_file.unlink(missing_ok=True)
-    command = [
-        "ogr2ogr",
-        "--debug",
-        "OFF",
-        "-nln",
-        sink_file.stem,
-        sink_file.as_gdal(),
-        tmp_combined_file.as_gdal(),
-    ]
-    subprocess.run(command, check=True)
+    parallel_copy_to(tmp_combined_file, sink_file)
     return f"Uploaded {tmp_combined_file} to {sink_file}"
 
 
@@ -179,50 +320,82 @@ def landing__av():
     # https://github.com/fsspec/gcsfs/issues/379
     mp.set_start_method("spawn")
 
-    logging.info("Cleaning up scratch folder...")
-    SCRATCH_FOLDER.clean_dir()
+    logging.info(f"Reading meta data...")
+    meta_text, meta_validators = fetch_meta_text(SOURCE_META_URL, META_VALIDATORS_FILE)
+    if meta_text is None:
+        logging.info(f"Meta data unchanged since last run, nothing to do!")
+        return
+
+    # Chunks are kept across runs, so only changed zip files are processed.
+    logging.info("Cleaning up scratch zip folder...")
+    (SCRATCH_FOLDER / "zip").clean_dir()
 
     logging.info(f"Gathering existing zip files...")
     sink_raw_folder = SINK_FOLDER / "raw"
     existing_zip = get_existing_zip(sink_raw_folder)
 
-    logging.info(f"Reading meta data...")
-    zip_sink_source_map = sink_source_map_from_meta(SOURCE_META_URL, sink_raw_folder)
-    incoming_zip = set(zip_sink_source_map.keys())
+    logging.info(f"Parsing meta data...")
+    zip_sink_source_map = sink_source_map_from_meta(meta_text, sink_raw_folder)
+    incoming_zip = zip_sink_source_map.keys()
+    del meta_text
 
     logging.info(f"Download new zip files...")
-    to_download = incoming_zip.difference(existing_zip)
+    etags = read_json(ZIP_ETAGS_FILE, {})
+    to_download = incoming_zip - existing_zip
     args = [(sink_path, zip_sink_source_map[sink_path]) for sink_path in to_download]
-    with Pool(processes=4) as pool:
-        for i, result_msg in enumerate(pool.imap_unordered(download_zip, args), 1):
-            logging.info(f"{i}/{len(args)} {result_msg}")
+    new_etags = asyncio.run(download_zips(args, existing_zip - incoming_zip, etags))
+    # Keep the ETags of unchanged zip files, drop the ones of outdated zip files.
+    etags = {
+        p.name: etags[p.name] for p in incoming_zip & existing_zip if p.name in etags
+    }
+    write_json(ZIP_ETAGS_FILE, {**etags, **new_etags})
 
     logging.info(f"Delete outdated zip files...")
-    delete_outdated_zip(incoming_zip, existing_zip)
+    # Existing zip files may have been renamed, so gather them again.
+    delete_outdated_zip(incoming_zip, get_existing_zip(sink_raw_folder))
+
+    logging.info(f"Delete outdated chunks...")
+    zip_paths = list(sink_raw_folder.glob("*.zip"))
+    delete_outdated_chunks(
+        SCRATCH_FOLDER, {p.stem for p in zip_paths}, FILES_TO_EXTRACT
+    )
 
     logging.info(f"Extract data from zip files...")
-    args = [
-        (zip_path, FILES_TO_EXTRACT, SCRATCH_FOLDER)
-        for zip_path in sink_raw_folder.glob("*.zip")
-    ]
-    with Pool(processes=mp.cpu_count() - 1) as pool:
+    # The zip file name contains its asof date, so a processed marker for the
+    # same name means its chunks are up to date. All markers are listed at once
+    # instead of probing each of them from the workers.
+    processed = {p.stem for p in (SCRATCH_FOLDER / "processed").glob("*.ok")}
+    to_process = [p for p in zip_paths if p.stem not in processed]
+    # Create the output folders once here instead of in every worker task.
+    chunk_folders = [SCRATCH_FOLDER / f.stem / "chunks" for f in FILES_TO_EXTRACT]
+    for folder in chunk_folders + [SCRATCH_FOLDER / "processed"]:
+        folder.mkdir(parents=True, exist_ok=True)
+    logging.info(f"{len(zip_paths) - len(to_process)} zip files already processed.")
+    args = [(zip_path, FILES_TO_EXTRACT, SCRATCH_FOLDER) for zip_path in to_process]
+    with Pool(processes=get_process_count()) as pool:
         for i, result_msg in enumerate(pool.imap_unordered(process_zip, args), 1):
             logging.info(f"{i}/{len(args)} {result_msg}")
 
     logging.info(f"Combine...")
     args = [SCRATCH_FOLDER / f.stem for f in FILES_TO_EXTRACT.keys()]
-    with Pool(processes=min(len(args), mp.cpu_count() - 1)) as pool:
+    with Pool(processes=min(len(args), get_process_count())) as pool:
         for i, result_msg in enumerate(pool.imap_unordered(combine, args), 1):
             logging.info(f"{i}/{len(args)} {result_msg}")
 
     logging.info(f"Upload...")
     args = [(SCRATCH_FOLDER / f.stem, sink) for f, sink in FILES_TO_EXTRACT.items()]
-    with Pool(processes=min(len(args), mp.cpu_count() - 1)) as pool:
+    with Pool(processes=min(len(args), get_process_count())) as pool:
         for i, result_msg in enumerate(pool.imap_unordered(upload, args), 1):
             logging.info(f"{i}/{len(args)} {result_msg}")
 
-    logging.info("Cleaning up scratch folder...")
-    SCRATCH_FOLDER.clean_dir()
+    logging.info("Cleaning up scratch zip folder and combined files...")
+    (SCRATCH_FOLDER / "zip").clean_dir()
+    for f in FILES_TO_EXTRACT.keys():
+        (SCRATCH_FOLDER / f.stem / "combined.fgb").unlink(missing_ok=True)
+
+    # Only store the validators after a successful run, so failed runs are retried.
+    if meta_validators:
+        write_json(META_VALIDATORS_FILE, meta_validators)
 
     logging.info(f"All done!")
 
@@ -5,11 +5,21 @@ GWR data has no explicit asof date, but rather seems to be updated daily.
 SOURCE_OUTDATED_DAYS specifies how many days old the data can be at most before updating.
 """
 
-from util import PandaPath, get_metadata_asof, set_metadata_asof_now, extract_zip_file
+from util import (
+    PandaPath,
+    get_metadata_asof,
+    set_metadata_asof_now,
+    extract_zip_file,
+    make_valid_geometries,
+)
 import pandas as pd
 import geopandas as gpd
+import pyogrio
+import shapely
 import logging
-import subprocess
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple
 
 logging.basicConfig(
     format="%(asctime)s %(levelname)-8s %(message)s",
@@ -26,58 +36,130 @@ SCRATCH_FOLDER = PandaPath("/workspaces/pretty_panda/data/scratch/ch.bfs.gwr")
 SINK_FOLDER = PandaPath("/workspaces/pretty_panda/data/landing/ch.bfs.gwr")
 SINK_FILE = SINK_FOLDER / "gwr_buildings.fgb"
 
-
-def create_buildings_file(extracted_zip_folder):
-    logging.info(f"Reading building geometries...")
-    buildings_path = extracted_zip_folder / "buildings.geojson"
-    # Specify Switzerland bbox (xmin, ymin, xmax, ymax) in epsg2056,
-    # because the GWR data contains an outlier building in the middle of the ocean >.<
-    buildings = gpd.read_file(
-        buildings_path, bbox=(2485071, 1074261, 2837119, 1299941), engine="pyogrio"
-    )[["egid", "geometry"]]
-    assert buildings.crs.to_epsg() == 2056
-    assert all(buildings.geometry.is_valid)
-    assert not any(buildings["egid"].duplicated())
-    buildings.set_index("egid", inplace=True)
-
-    logging.info(f"Reading building data...")
+# Building attributes kept from gebaeude_batiment_edificio.csv, see
+# https://www.housing-stat.ch/de/help/42.html for the feature catalogue.
+GWR_KEEP_COLUMNS = [
+    "EGID",  # Federal building identifier
+    "GGDENR",  # Municipality number
+    "GGDENAME",  # Municipality name
+    "EGRID",  # Federal parcel identifier
+    "LPARZ",  # Parcel number
+    "GEBNR",  # Official building number
+    "GBEZ",  # Building name
+    "GSTAT",  # Building status
+    "GKAT",  # Building category
+    "GKLAS",  # Building class
+    "GBAUJ",  # Construction year
+    "GBAUP",  # Construction period
+    "GABBJ",  # Demolition year
+    "GAREA",  # Building area
+    "GASTW",  # Number of floors
+    "GANZWHG",  # Number of dwellings
+    "GEBF",  # Energy reference area
+    "GWAERZH1",  # Heat generator heating 1
+    "GENH1",  # Energy source heating 1
+    "GWAERDATH1",  # Update date heating 1
+]
+
+
+def read_building_data(
+    data_path: PandaPath, cache_file: PandaPath, raw_file: PandaPath
+) -> pd.DataFrame:
+    # Parsed data is cached as parquet and reused while newer than the raw zip
+    # and holding the columns to keep.
+    if cache_file.exists() and cache_file.stat().st_mtime > raw_file.stat().st_mtime:
+        with cache_file.open("rb") as f:
+            building_data = pd.read_parquet(f)
+        if set(building_data.columns) == set(GWR_KEEP_COLUMNS):
+            return building_data
+        logging.info(f"Columns of {cache_file} changed, parse {data_path} again...")
     # Specify dtype for columns where pandas is not able to infer datatype.
-    data_path = extracted_zip_folder / "gebaeude_batiment_edificio.csv"
+    # The pyarrow engine parses in parallel native threads.
     building_data = pd.read_csv(
-        data_path, sep="\t", dtype={"LPARZ": "str", "GEBNR": "str"}
+        data_path,
+        sep="\t",
+        usecols=GWR_KEEP_COLUMNS,
+        dtype={"LPARZ": "str", "GEBNR": "str"},
+        engine="pyarrow",
     )
-    assert not any(building_data["EGID"].duplicated())
-    building_data.set_index("EGID", inplace=True)
+    assert building_data["EGID"].is_unique
+    cache_file.ensure_parent()
+    with cache_file.open("wb") as f:
+        building_data.to_parquet(f, compression="zstd")
+    return building_data
+
+
+def read_building_geometries(buildings_path: PandaPath) -> Tuple[pd.DataFrame, str]:
+    """
+    Read building egids and geometries along with the CRS. Geometries are kept
+    as WKB bytes in column "wkb" and only converted to shapely at write time.
+    """
+    # Specify Switzerland bbox (xmin, ymin, xmax, ymax) in epsg2056,
+    # because the GWR data contains an outlier building in the middle of the ocean >.<
+    bbox = (2485071, 1074261, 2837119, 1299941)
+    # Arrow stream reading requires GDAL >= 3.6.
+    if pyogrio.__gdal_version__ >= (3, 6, 0):
+        meta, table = pyogrio.raw.read_arrow(
+            buildings_path.as_gdal(), columns=["egid"], bbox=bbox
+        )
+        geometry_name = meta["geometry_name"] or "wkb_geometry"
+        buildings = table.to_pandas().rename(columns={geometry_name: "wkb"})
+    else:
+        meta, _, wkb, field_data = pyogrio.raw.read(
+            buildings_path.as_gdal(), columns=["egid"], bbox=bbox
+        )
+        buildings = pd.DataFrame({"egid": field_data[0], "wkb": wkb})
+    return buildings[["egid", "wkb"]], meta["crs"]
+
+
+def create_buildings_file(extracted_zip_folder, sink_raw_file):
+    # Both reads spend most time in C code releasing the GIL, so the
+    # building data is read in a thread while the geometries are read.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        logging.info(f"Reading building data...")
+        data_path = extracted_zip_folder / "gebaeude_batiment_edificio.csv"
+        cache_file = sink_raw_file.parent / "gebaeude_batiment_edificio.parquet"
+        building_data_future = executor.submit(
+            read_building_data, data_path, cache_file, sink_raw_file
+        )
 
-    logging.info(f"Join geometries and data...")
-    buildings = buildings.join(building_data, how="left").reset_index()
+        logging.info(f"Reading building geometries...")
+        buildings_path = extracted_zip_folder / "buildings.geojson"
+        buildings, crs = read_building_geometries(buildings_path)
+        assert crs == "EPSG:2056"
+        assert buildings["egid"].is_unique
+        # Invalid geometries are repaired on upload, so the full validity
+        # assertion is only done on request.
+        if os.environ.get("GWR_VALIDATE"):
+            assert shapely.is_valid(shapely.from_wkb(buildings["wkb"].values)).all()
+
+        building_data = building_data_future.result()
 
-    scratch_file = SCRATCH_FOLDER / "buildings.fgb"
-    logging.info(f"Writing temprary file to {scratch_file}...")
-    SCRATCH_FOLDER.mkdir(parents=True, exist_ok=True)
-    buildings.to_file(scratch_file, engine="pyogrio")
+    logging.info(f"Join geometries and data...")
+    buildings = buildings.merge(
+        building_data, left_on="egid", right_on="EGID", how="left", sort=False
+    ).drop(columns=["EGID"])
 
-    return scratch_file
+    return buildings
 
 
-def upload(scratch_file: PandaPath):
+def upload(buildings: pd.DataFrame):
     logging.info(f"Uploading to {SINK_FILE}...")
-    SINK_FILE.parent.mkdir(parents=True, exist_ok=True)
+    geoms = make_valid_geometries(shapely.from_wkb(buildings["wkb"].values))
+    buildings = gpd.GeoDataFrame(
+        buildings.drop(columns=["wkb"]), geometry=geoms, crs="EPSG:2056"
+    )
+
+    SINK_FILE.ensure_parent()
     SINK_FILE.unlink(missing_ok=True)
-    command = [
-        "ogr2ogr",
-        "-progress",
-        "--debug",
-        "OFF",
-        "-makevalid",
-        "-nln",
-        SINK_FILE.stem,
-        "-nlt",
-        "PROMOTE_TO_MULTI",
+    pyogrio.write_dataframe(
+        buildings,
         SINK_FILE.as_gdal(),
-        scratch_file.as_gdal(),
-    ]
-    subprocess.run(command, check=True)
+        layer=SINK_FILE.stem,
+        driver="FlatGeobuf",
+        promote_to_multi=True,
+        SPATIAL_INDEX="YES",
+    )
 
 
 def landing__gwr():
@@ -96,10 +178,10 @@ def landing__gwr():
     extracted_folder = extract_zip_file(sink_raw_file, SCRATCH_FOLDER)
 
     logging.info(f"Processing {extracted_folder}...")
-    scratch_file = create_buildings_file(extracted_folder)
+    buildings = create_buildings_file(extracted_folder, sink_raw_file)
 
     logging.info(f"Uploading to {SINK_FILE}...")
-    upload(scratch_file)
+    upload(buildings)
 
     logging.info("Cleaning up scratch folder...")
     SCRATCH_FOLDER.clean_dir()
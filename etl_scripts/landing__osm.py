@@ -4,12 +4,11 @@ Download OSM data from Geofabrik:
 http://download.geofabrik.de/europe/switzerland.html
 """
 
-from util import PandaPath, extract_zip_file, retry
-from multiprocessing.pool import Pool
-import subprocess
+from util import PandaPath, extract_zip_file, retry, get_process_count
+from multiprocessing.pool import ThreadPool
+from osgeo import gdal
 from typing import Set
 import logging
-import multiprocessing as mp
 
 logging.basicConfig(
     format="%(asctime)s %(levelname)-8s %(message)s",
@@ -17,6 +16,8 @@ logging.basicConfig(
     datefmt="%Y-%m-%d %H:%M:%S",
 )
 
+gdal.UseExceptions()
+
 SOURCE_FILE = PandaPath(
     "http://download.geofabrik.de/europe/switzerland-latest-free.shp.zip"
 )
@@ -51,32 +52,24 @@ def extract_and_upload(args) -> str:
     if file_path.name == "README":
         file_path.copy_to(sink_path, bytes=False)
     else:
-        sink_path.parent.mkdir(parents=True, exist_ok=True)
+        sink_path.ensure_parent()
         sink_path.unlink(missing_ok=True)
-        command = [
-            "ogr2ogr",
-            "--debug",
-            "OFF",
-            "-makevalid",
-            "-t_srs",
-            "EPSG:2056",
-            "-nlt",
-            "PROMOTE_TO_MULTI",
-            "-nln",
-            sink_path.stem,
+        gdal.VectorTranslate(
             sink_path.as_gdal(),
             file_path.as_gdal(),
-        ]
-        subprocess.run(command, check=True)
+            options=gdal.VectorTranslateOptions(
+                makeValid=True,
+                dstSRS="EPSG:2056",
+                geometryType="PROMOTE_TO_MULTI",
+                layerName=sink_path.stem,
+            ),
+        )
     return f"Extracted {file_path} to {sink_path}."
 
 
 def landing__osm():
     logging.info(f"Start {__name__}")
 
-    # https://github.com/fsspec/gcsfs/issues/379
-    mp.set_start_method("spawn")
-
     sink_raw_file = SINK_FOLDER / "raw" / SOURCE_FILE.name
     if sink_raw_file.exists():
         logging.info(
@@ -99,7 +92,8 @@ def landing__osm():
         (extract_folder, file_in_zip, sink_path)
         for file_in_zip, sink_path in FILES_TO_EXTRACT.items()
     ]
-    with Pool(processes=min(len(args), mp.cpu_count() - 1)) as pool:
+    # GDAL releases the GIL during conversions, so threads are sufficient.
+    with ThreadPool(processes=min(len(args), get_process_count())) as pool:
         for i, result_msg in enumerate(
             pool.imap_unordered(extract_and_upload, args), 1
         ):
@@ -9,12 +9,25 @@ Sadly, it seems that as of 2023-11 something is broken with the geopackage zip c
 which is why we work with the filegeodatabase >.<
 """
 
-from util import PandaPath, get_metadata_asof, set_metadata_asof_now
-import json
+from util import (
+    PandaPath,
+    get_metadata_asof,
+    set_metadata_asof_now,
+    extract_zip_file,
+    get_http_session,
+    parallel_copy_to,
+    get_process_count,
+    get_ogr_union_vrt,
+    read_json,
+    write_json,
+)
+from multiprocessing.pool import Pool
+import orjson
 from datetime import datetime
-from typing import Tuple
-import subprocess
+from typing import List, Tuple, Optional
+from osgeo import gdal
 import logging
+import multiprocessing as mp
 
 logging.basicConfig(
     format="%(asctime)s %(levelname)-8s %(message)s",
@@ -22,12 +35,18 @@ logging.basicConfig(
     datefmt="%Y-%m-%d %H:%M:%S",
 )
 
+gdal.UseExceptions()
+
 SOURCE_STAC_ITEM = PandaPath(
     "https://data.geo.admin.ch/api/stac/v0.9/collections/ch.bfe.solarenergie-eignung-daecher/items/solarenergie-eignung-daecher"
 )
 SOURCE_STAC_ASSET_KEY = "solarenergie-eignung-daecher_2056.gdb.zip"
 SOURCE_FILE_GDB_LAYERNAME = "SOLKAT_CH_DACH"
 
+SCRATCH_FOLDER = PandaPath(
+    "/workspaces/pretty_panda/data/scratch/ch.bfe.solarenergie-eignung"
+)
+
 SINK_FOLDER = PandaPath(
     "gs://folimar-geotest-store001/landing/ch.bfe.solarenergie-eignung"
 )
@@ -35,49 +54,146 @@ SINK_FOLDER = PandaPath(
 #     "/workspaces/pretty_panda/data/landing/ch.bfe.solarenergie-eignung"
 # )
 SINK_FILE_SOLARDAECHER = SINK_FOLDER / "solarenergie-eignung-daecher_2056.fgb"
+STAC_CACHE_FILE = SINK_FOLDER / ".stac_cache.json"
+
+
+def read_stac_item(
+    stac_item: PandaPath, cache_file: PandaPath
+) -> Tuple[Optional[dict], Optional[str]]:
+    """
+    Read a STAC item and return it along with its ETag. If the item did not
+    change since the ETag stored in cache_file, return (None, None) without
+    any payload transfer or parsing.
+    """
+    cache = read_json(cache_file, {})
+    headers = {"If-None-Match": cache["etag"]} if cache.get("etag") else {}
+    response = get_http_session().get(str(stac_item), headers=headers)
+    if response.status_code == 304:
+        return None, None
+    response.raise_for_status()
+    return orjson.loads(response.content), response.headers.get("ETag")
 
 
 def get_asset_from_stac_item(
-    stac_item: PandaPath, stac_asset_key: str
+    stac_item: dict, stac_asset_key: str
 ) -> Tuple[PandaPath, datetime]:
-    stac_item = json.loads(stac_item.read_text())
     asset = stac_item["assets"][stac_asset_key]
     asof = datetime.strptime(asset["updated"], "%Y-%m-%dT%H:%M:%S.%fZ")
     asset_path = PandaPath(asset["href"])
     return asset_path, asof
 
 
+def get_fid_ranges(
+    source_file: PandaPath, layer_name: str, parts: int
+) -> List[Tuple[int, Optional[int]]]:
+    """
+    Split the features of a layer into contiguous FID ranges. The last range is
+    open ended, so features are never missed, even if FIDs have gaps.
+    """
+    ds = gdal.OpenEx(source_file.as_gdal(), gdal.OF_VECTOR)
+    count = ds.GetLayerByName(layer_name).GetFeatureCount()
+    del ds
+    step = -(-count // parts)  # ceil division
+    starts = list(range(1, count + 1, step)) or [1]
+    return [(start, start + step) for start in starts[:-1]] + [(starts[-1], None)]
+
+
+def translate_part(args) -> str:
+    source_file, layer_name, (fid_start, fid_end), part_file = args
+    where = f"FID >= {fid_start}"
+    if fid_end is not None:
+        where += f" AND FID < {fid_end}"
+    part_file.unlink(missing_ok=True)
+    gdal.VectorTranslate(
+        part_file.as_gdal(),
+        source_file.as_gdal(),
+        options=gdal.VectorTranslateOptions(
+            format="FlatGeobuf",
+            layers=[layer_name],
+            layerName=part_file.stem,
+            where=where,
+            makeValid=True,
+            geometryType="PROMOTE_TO_MULTI",
+            dstSRS="EPSG:2056",
+            reproject=False,  # assign instead of transform, like -a_srs
+            layerCreationOptions=["SPATIAL_INDEX=NO"],
+        ),
+    )
+    return f"Translated features {where} to {part_file}."
+
+
 def landing__solareignung():
     logging.info(f"Start {__name__}")
 
-    asset_path, asset_asof = get_asset_from_stac_item(
-        SOURCE_STAC_ITEM, SOURCE_STAC_ASSET_KEY
-    )
+    # https://github.com/fsspec/gcsfs/issues/379
+    mp.set_start_method("spawn")
+
+    stac_item, stac_etag = read_stac_item(SOURCE_STAC_ITEM, STAC_CACHE_FILE)
+    if stac_item is None:
+        logging.info(f"STAC item unchanged since last run, nothing to do!")
+        return
+    asset_path, asset_asof = get_asset_from_stac_item(stac_item, SOURCE_STAC_ASSET_KEY)
+
+    # The asset is downloaded once to local scratch and extracted there. The
+    # members of the zip are deflated, so workers reading FID ranges straight
+    # from the remote zip would each inflate everything before their range.
+    scratch_raw_file = SCRATCH_FOLDER / asset_path.name
+    logging.info(f"Newer asset available. Download raw file to {scratch_raw_file}...")
+    parallel_copy_to(asset_path, scratch_raw_file)
 
     sink_raw_file = SINK_FOLDER / "raw" / asset_path.name
-    logging.info(f"Newer asset available. Copy raw file to {sink_raw_file}...")
-    asset_path.copy_to(sink_raw_file)
+    logging.info(f"Copy raw file to {sink_raw_file}...")
+    parallel_copy_to(scratch_raw_file, sink_raw_file)
+
+    logging.info(f"Extract {scratch_raw_file}...")
+    gdb_folder = extract_zip_file(scratch_raw_file, SCRATCH_FOLDER / "gdb")
+    # The zip contains either the .gdb folder itself or only its content.
+    gdb_folder = next(gdb_folder.glob("*.gdb"), gdb_folder)
 
     logging.info(
-        f"Extracting layer {SOURCE_FILE_GDB_LAYERNAME} from {sink_raw_file} to {SINK_FILE_SOLARDAECHER}..."
+        f"Extracting layer {SOURCE_FILE_GDB_LAYERNAME} from {gdb_folder} to {SINK_FILE_SOLARDAECHER}..."
+    )
+    # MakeValid is CPU bound, so FID ranges of the layer are translated in
+    # parallel to scratch files and merged into the sink file afterwards.
+    parts_folder = SCRATCH_FOLDER / "parts"
+    parts_folder.clean_dir()
+    fid_ranges = get_fid_ranges(
+        gdb_folder, SOURCE_FILE_GDB_LAYERNAME, get_process_count()
     )
-    SINK_FILE_SOLARDAECHER.parent.mkdir(parents=True, exist_ok=True)
+    args = [
+        (
+            gdb_folder,
+            SOURCE_FILE_GDB_LAYERNAME,
+            fid_range,
+            parts_folder / f"part_{i:04d}.fgb",
+        )
+        for i, fid_range in enumerate(fid_ranges)
+    ]
+    with Pool(processes=len(args)) as pool:
+        for i, result_msg in enumerate(pool.imap_unordered(translate_part, args), 1):
+            logging.info(f"{i}/{len(args)} {result_msg}")
+
+    logging.info(f"Merging parts into {SINK_FILE_SOLARDAECHER}...")
+    SINK_FILE_SOLARDAECHER.ensure_parent()
     SINK_FILE_SOLARDAECHER.unlink(missing_ok=True)
-    command = [
-        "ogr2ogr",
-        "-progress",
-        "--debug",
-        "OFF",
-        "-makevalid",
-        "-nlt",
-        "PROMOTE_TO_MULTI",
-        "-a_srs",
-        "EPSG:2056",
+    gdal.VectorTranslate(
         SINK_FILE_SOLARDAECHER.as_gdal(),
-        sink_raw_file.as_gdal(),
-        SOURCE_FILE_GDB_LAYERNAME,
-    ]
-    subprocess.run(command, check=True)
+        get_ogr_union_vrt(
+            [part_file for *_, part_file in args], SOURCE_FILE_GDB_LAYERNAME
+        ),
+        options=gdal.VectorTranslateOptions(
+            format="FlatGeobuf",
+            layerName=SOURCE_FILE_GDB_LAYERNAME,
+            callback=gdal.TermProgress_nocb,
+        ),
+    )
+    parts_folder.clean_dir()
+    (SCRATCH_FOLDER / "gdb").clean_dir()
+    scratch_raw_file.unlink(missing_ok=True)
+
+    # Only store the ETag after a successful run, so failed runs are retried.
+    if stac_etag:
+        write_json(STAC_CACHE_FILE, {"etag": stac_etag})
 
     logging.info(f"All done!")
 
@@ -3,11 +3,20 @@
 
 """
 
-from util import PandaPath, get_ch_2056_processing_extents, retry
-from typing import Tuple
+from util import (
+    PandaPath,
+    get_ch_2056_processing_extents,
+    retry,
+    get_process_count,
+    get_ogr_union_vrt,
+    parallel_copy_to,
+)
+from typing import Tuple, List, Dict, Optional
 import geopandas as gpd
 import pandas as pd
-import subprocess
+import pyogrio
+import shapely
+from osgeo import gdal
 import logging
 import multiprocessing as mp
 from multiprocessing.pool import Pool
@@ -19,6 +28,8 @@ logging.basicConfig(
     datefmt="%Y-%m-%d %H:%M:%S",
 )
 
+gdal.UseExceptions()
+
 SOURCE_ROOT = PandaPath("/workspaces/pretty_panda/data/landing")
 SOURCE_AV_FLAECHE = (
     SOURCE_ROOT / "ch.swisstopo-vd.amtliche-vermessung/Bo_BoFlaeche_A.fgb"
@@ -29,40 +40,87 @@ SOURCE_AV_NUMMER = (
 SOURCE_GWR = SOURCE_ROOT / "ch.bfs.gwr/gwr_buildings.fgb"
 SOURCE_OSM_BUILDINGS = SOURCE_ROOT / "de.geofabrik/gis_osm_buildings_a_free_1.fgb"
 
+SOURCES = {
+    "av_flaeche": SOURCE_AV_FLAECHE,
+    "av_nummer": SOURCE_AV_NUMMER,
+    "gwr": SOURCE_GWR,
+    "osm_buildings": SOURCE_OSM_BUILDINGS,
+}
+
 SCRATCH_FOLDER = PandaPath("/workspaces/pretty_panda/data/scratch/gebaeude")
 
 SINK_FILE = PandaPath("/workspaces/pretty_panda/data/refined/buildings/buildings.fgb")
 
+AV_FLAECHE_COLUMNS = [
+    "OBJID",
+    "QUALITAET",
+    "QUALITAET_",
+    "R1_OBJID",
+    "R1_NBIDENT",
+    "R1_IDENTIF",
+    "R1_BESCHRE",
+    "R1_GUELTIG",
+    "R1_GUELTI1",
+    "R1_GUELTI2",
+    "R1_DATUM1",
+    "etl_zip_source",
+]
+
+
+def read_bbox(
+    path: PandaPath,
+    bbox: Tuple[float, float, float, float],
+    columns: Optional[List[str]] = None,
+    where: Optional[str] = None,
+) -> gpd.GeoDataFrame:
+    """
+    Read the features within bbox. Column selection and attribute filter are
+    pushed down to GDAL, so only the required fields are decoded. The arrow
+    stream interface is used where GDAL supports it (>= 3.6).
+    """
+    return pyogrio.read_dataframe(
+        path.as_gdal(),
+        bbox=bbox,
+        columns=columns,
+        where=where,
+        use_arrow=pyogrio.__gdal_version__ >= (3, 6, 0),
+    )
+
+
+def cache_sources(
+    sources: Dict[str, PandaPath], cache_folder: PandaPath
+) -> Dict[str, PandaPath]:
+    """
+    Copy remote sources once to the scratch folder. Every bbox is read by a worker,
+    so reading from a local copy avoids repeated remote opens, header and spatial
+    index reads of the same files for each of the hundreds of bboxes.
+    Local sources are used in place.
+    """
+    cache_folder.mkdir(parents=True, exist_ok=True)
+    cached = {}
+    for name, source in sources.items():
+        if source.is_local():
+            cached[name] = source
+            continue
+        cached[name] = cache_folder / source.name
+        logging.info(f"Caching {source} to {cached[name]}...")
+        parallel_copy_to(source, cached[name])
+    return cached
+
 
 def combine_av_and_osm_footprints(
-    bbox: Tuple[float, float, float, float]
+    bbox: Tuple[float, float, float, float], sources: Dict[str, PandaPath]
 ) -> gpd.GeoDataFrame:
 
-    av_footprints = gpd.read_file(SOURCE_AV_FLAECHE.as_gdal(), bbox=bbox)
-    osm_footprints = gpd.read_file(SOURCE_OSM_BUILDINGS.as_gdal(), bbox=bbox)
-
-    # For AV footprints we want only buildings
-    av_footprints = av_footprints[av_footprints.ART_TXT == "Gebaeude"]
-
-    # Only keep the columns we need
-    av_footprints = av_footprints[
-        [
-            "OBJID",
-            "QUALITAET",
-            "QUALITAET_",
-            "R1_OBJID",
-            "R1_NBIDENT",
-            "R1_IDENTIF",
-            "R1_BESCHRE",
-            "R1_GUELTIG",
-            "R1_GUELTI1",
-            "R1_GUELTI2",
-            "R1_DATUM1",
-            "etl_zip_source",
-            "geometry",
-        ]
-    ]
-    osm_footprints = osm_footprints[["osm_id", "geometry"]]
+    # For AV footprints we want only buildings and only the columns we need
+    av_footprints = read_bbox(
+        sources["av_flaeche"],
+        bbox,
+        columns=AV_FLAECHE_COLUMNS + ["ART_TXT"],
+        where="ART_TXT = 'Gebaeude'",
+    )
+    av_footprints = av_footprints[AV_FLAECHE_COLUMNS + ["geometry"]]
+    osm_footprints = read_bbox(sources["osm_buildings"], bbox, columns=["osm_id"])
 
     # Prefix columns of av_footprints and osm_footprints (all except geometry)
     av_footprints_prefixed = av_footprints.add_prefix("avFl_")
@@ -105,35 +163,48 @@ def combine_av_and_osm_footprints(
 
 
 def join_data_to_footprints(
-    bbox: Tuple[float, float, float, float], footprints: gpd.GeoDataFrame
+    bbox: Tuple[float, float, float, float],
+    footprints: gpd.GeoDataFrame,
+    sources: Dict[str, PandaPath],
 ) -> gpd.GeoDataFrame:
-    av_points = gpd.read_file(SOURCE_AV_NUMMER.as_gdal(), bbox=bbox)
-    gwr_points = gpd.read_file(SOURCE_GWR.as_gdal(), bbox=bbox)
+    # Only read the columns we need
+    av_points = read_bbox(
+        sources["av_nummer"],
+        bbox,
+        columns=["OBJID", "R1_OBJID", "R1_GEBAEUD", "R1_GWR_EGI"],
+    )
+    gwr_points = read_bbox(sources["gwr"], bbox)
+
+    # Build the spatial index on the footprints once and query both point sets
+    footprints = footprints.reset_index(drop=True)
+    tree = shapely.STRtree(footprints.geometry.values)
+    for points, prefix in [(av_points, "avNr_"), (gwr_points, "gwr_")]:
+        point_idx, footprint_idx = tree.query(
+            points.geometry.values, predicate="intersects"
+        )
+        # Prefix columns of the points (all except geometry)
+        matches = (
+            pd.DataFrame(points.drop(columns="geometry"))
+            .iloc[point_idx]
+            .add_prefix(prefix)
+            .set_index(footprint_idx)
+        )
+        # Left join on the footprint position, like a left sjoin
+        footprints = footprints.join(matches, how="left")
 
-    # Only keep the columns we need
-    av_points = av_points[["OBJID", "R1_OBJID", "R1_GEBAEUD", "R1_GWR_EGI", "geometry"]]
+    return footprints
 
-    # Prefix columns of av_footprints and osm_footprints (all except geometry)
-    av_points_prefixed = av_points.add_prefix("avNr_")
-    av_points_prefixed = av_points_prefixed.rename(
-        columns={"avNr_geometry": "geometry"}
-    )
-    gwr_points_prefixed = gwr_points.add_prefix("gwr_")
-    gwr_points_prefixed = gwr_points_prefixed.rename(
-        columns={"gwr_geometry": "geometry"}
-    )
 
-    footprints = gpd.sjoin(
-        footprints, av_points_prefixed, how="left", predicate="intersects"
-    )
-    footprints = footprints.drop(columns=["index_right"])
+# Sources of the current worker process, set once by init_worker.
+WORKER_SOURCES: Dict[str, PandaPath] = {}
 
-    footprints = gpd.sjoin(
-        footprints, gwr_points_prefixed, how="left", predicate="intersects"
-    )
-    footprints = footprints.drop(columns=["index_right"])
 
-    return footprints
+def init_worker(sources: Dict[str, PandaPath]) -> None:
+    """
+    Keep the sources in a worker global, so they are passed once per worker
+    instead of with every bbox task.
+    """
+    WORKER_SOURCES.update(sources)
 
 
 def process(bbox: Tuple[float, float, float, float], chunks_folder: PandaPath) -> str:
@@ -141,48 +212,35 @@ def process(bbox: Tuple[float, float, float, float], chunks_folder: PandaPath) -
     chunk_path = chunks_folder / f"{bbox_str}.gpkg"
     if chunk_path.exists():
         return f"Chunk {chunk_path} already exists - skip"
-    footprints = combine_av_and_osm_footprints(bbox)
+    footprints = combine_av_and_osm_footprints(bbox, WORKER_SOURCES)
     if len(footprints) == 0:
         return "No footprints found"
-    footprints = join_data_to_footprints(bbox, footprints)
+    footprints = join_data_to_footprints(bbox, footprints, WORKER_SOURCES)
     footprints.to_file(chunk_path.as_gdal(), driver="GPKG", SPATIAL_INDEX="NO")
     return f"Created {chunk_path}"
 
 
-@retry
-def combine(scratch_folder: PandaPath) -> PandaPath:
-    chunks = scratch_folder / "chunks" / "*.gpkg"
-    combined_file = scratch_folder / f"combined.gpkg"
-    command = [
-        "ogrmerge.py",
-        "-f",
-        "GPKG",
-        "-progress",
-        "-single",
-        "-overwrite_ds",
-        "-o",
-        combined_file.as_gdal(),
-        chunks.as_gdal(),
-    ]
-    subprocess.run(command, check=True)
-    return combined_file
-
-
-@retry
-def upload(source_file: PandaPath, sink_file: PandaPath) -> None:
-    sink_file.parent.mkdir(parents=True, exist_ok=True)
+# A retry rewrites the whole sink file, so only try once more.
+@retry(max_attempts=2)
+def combine_and_upload(chunks_folder: PandaPath, sink_file: PandaPath) -> None:
+    """
+    Merge all chunks straight into the sink file, without an intermediate
+    combined file that would have to be written and read back once more.
+    The chunks are exposed as one layer through an OGR VRT union layer, like
+    ogrmerge.py -single does, and translated in-process.
+    """
+    vrt = get_ogr_union_vrt(sorted(chunks_folder.glob("*.gpkg")), sink_file.stem)
+    sink_file.ensure_parent()
     sink_file.unlink(missing_ok=True)
-    command = [
-        "ogr2ogr",
-        "--debug",
-        "OFF",
-        "-progress",
-        "-nln",
-        sink_file.stem,
+    gdal.VectorTranslate(
         sink_file.as_gdal(),
-        source_file.as_gdal(),
-    ]
-    subprocess.run(command, check=True)
+        vrt,
+        options=gdal.VectorTranslateOptions(
+            format="FlatGeobuf",
+            layerName=sink_file.stem,
+            callback=gdal.TermProgress_nocb,
+        ),
+    )
 
 
 def refined__buildings():
@@ -194,23 +252,28 @@ def refined__buildings():
     # logging.info(f"Clean scratch folder {SCRATCH_FOLDER}")
     # SCRATCH_FOLDER.clean_dir()
 
+    logging.info(f"Cache sources...")
+    sources = cache_sources(SOURCES, SCRATCH_FOLDER / "sources")
+
     logging.info(f"Process chunks...")
     chunks_folder = SCRATCH_FOLDER / "chunks"
     chunks_folder.mkdir(parents=True, exist_ok=True)
 
     bboxes = list(get_ch_2056_processing_extents(30, 15))
-    with Pool(processes=mp.cpu_count() - 1) as pool:
+    process_bbox = partial(process, chunks_folder=chunks_folder)
+    processes = get_process_count()
+    # Hand out bboxes in batches to amortize the inter-process round trips.
+    chunksize = max(1, len(bboxes) // (4 * processes))
+    with Pool(
+        processes=processes, initializer=init_worker, initargs=(sources,)
+    ) as pool:
         for i, result_msg in enumerate(
-            pool.imap_unordered(partial(process, chunks_folder=chunks_folder), bboxes),
-            1,
+            pool.imap_unordered(process_bbox, bboxes, chunksize=chunksize), 1
         ):
             logging.info(f"{i}/{len(bboxes)} {result_msg}")
 
-    logging.info(f"Combine...")
-    combined_file = combine(SCRATCH_FOLDER)
-
-    logging.info(f"Upload...")
-    upload(combined_file, SINK_FILE)
+    logging.info(f"Combine and upload...")
+    combine_and_upload(chunks_folder, SINK_FILE)
 
     logging.info(f"Clean scratch folder {SCRATCH_FOLDER}")
     SCRATCH_FOLDER.clean_dir()